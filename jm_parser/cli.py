@@ -1,11 +1,10 @@
-import glob
 import os
 import shutil
 
 import click
 
 from . import parsing
-from . import scraping
+from .exceptions import DownloadsFailed
 
 DEFAULT_UC_BASE_URL = 'http://updates.jenkins-ci.org'
 PLUGIN_BASE_URL = 'https://plugins.jenkins.io/'
@@ -60,7 +59,8 @@ def report_supported_versions():
 
     This is mainly useful for human consumption.
 
-    This command does not cache information fetched from the internet.
+    The jenkins package repo metadata this is based on is cached, and only downloaded again when
+    it has changed upstream.
     """
     # doesn't take common options, always works on the same URL for all versions
     supported_versions = parsing.supported_versions()
@@ -82,7 +82,8 @@ def latest_xyz_version():
 
     This is mainly useful for script consumption, e.g. to set JENKINS_VERSION in test runs.
 
-    This command does not cache information fetched from the internet.
+    The jenkins package repo metadata this is based on is cached, and only downloaded again when
+    it has changed upstream.
     """
     supported_versions = parsing.supported_versions()
     supported_datestamp, xy_version, xyz_version, build_datestamp = supported_versions[-1]
@@ -134,6 +135,10 @@ def compile_distribution(plugin_lists_dir, dist_dir, xy_version):
     - plugin lists, including default, optional, core, and blacklist
 
     """
+    # scraping pulls in lxml, which none of the other commands need, so it's only imported by the
+    # command that needs it
+    from . import scraping
+
     if not xy_version:
         xy_versions = []
         # supported versions comes from earliest to newest, users would probably appreciate seeing
@@ -150,7 +155,6 @@ def compile_distribution(plugin_lists_dir, dist_dir, xy_version):
     for xy_version in xy_versions:
         # ensure plugin lists dir for xy_version exists
         xy_plugin_lists_dir = os.path.join(plugin_lists_dir, xy_version)
-        xy_plugin_lists_glob = os.path.join(xy_plugin_lists_dir, '*.txt')
         if not os.path.exists(xy_plugin_lists_dir):
             raise RuntimeError('Unable to find {} dir in {}'.format(xy_version, plugin_lists_dir))
         # ensure output dirs for plugins, rpm, and war exist in dist dir
@@ -160,15 +164,22 @@ def compile_distribution(plugin_lists_dir, dist_dir, xy_version):
         plugin_xy_dir = os.path.join(dist_dir, 'plugins', xy_version)
         os.makedirs(plugin_xy_dir, exist_ok=True)
         # and finally, copy over the current plugin txts for version
-        for txt_file in glob.glob(xy_plugin_lists_glob):
-            # there are other text files in plugin list dirs that we don't care about (e.g. core)
-            if os.path.basename(txt_file) not in ('default.txt', 'optional.txt'):
-                continue
-            dest = os.path.join(plugin_xy_dir, os.path.basename(txt_file))
-            click.echo('Copying {} plugin list to {}'.format(txt_file, dest))
-            shutil.copyfile(txt_file, dest)
-        # After all the prep work and copy of local stuff, scrape rpms and wars
+        with os.scandir(xy_plugin_lists_dir) as entries:
+            for entry in entries:
+                # there are other text files in plugin list dirs that we don't care about
+                # (e.g. core)
+                if entry.name not in parsing.PLUGIN_PROD_LISTS:
+                    continue
+                dest = os.path.join(plugin_xy_dir, entry.name)
+                click.echo('Copying {} plugin list to {}'.format(entry.path, dest))
+                shutil.copyfile(entry.path, dest)
+
+    # After all the prep work and copy of local stuff, scrape rpms and wars for all the versions
+    try:
         scraping.scrape_for_versions(xy_versions, dist_dir, allow_prompt=True)
+    except DownloadsFailed as exc:
+        # each failure has already been reported as it happened, so just exit with an error
+        raise click.ClickException(str(exc))
 
 
 @jm_cli_entry.command(name="diff-uc-plugins")
@@ -2,3 +2,12 @@ class PluginNotFound(RuntimeError):
     def __init__(self, plugin_name):
         msg = "Plugin {} not found in update center".format(plugin_name)
         super(PluginNotFound, self).__init__(msg)
+
+
+class DownloadsFailed(RuntimeError):
+    def __init__(self, errors):
+        # errors maps the local filename of each failed download, or the URL of each index page
+        # that couldn't be fetched, to the exception it raised
+        self.errors = errors
+        msg = "Failed to download {}".format(', '.join(sorted(errors)))
+        super(DownloadsFailed, self).__init__(msg)
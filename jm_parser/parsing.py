@@ -1,32 +1,48 @@
 import click
-import gzip
 import hashlib
 import json
 import os
 import time
 import warnings
-from collections import defaultdict
-from distutils.version import LooseVersion
-from xml.etree.ElementTree import fromstring
-
-import appdirs
-import arrow
+from collections import defaultdict, deque
+from functools import lru_cache
 
 from .exceptions import PluginNotFound
-from .plugin import JenkinsPlugin
+from .plugin import JenkinsPlugin, parse_version
 
 try:
     # py3
-    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
 except ImportError:
     # py2
-    from urllib2 import urlopen
+    from urllib2 import HTTPError, Request, urlopen
+
+try:
+    # orjson is optional, but loads the (rather large) UC JSON a good deal faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 UC_JSON = 'update-center.json'
-VERSION_1651 = LooseVersion('1.651')
+JENKINS_RPM_REPO = 'https://pkg.jenkins.io/redhat-stable/'
+JENKINS_RPM_VERSIONS_JSON = 'jenkins-rpm-versions.json'
+# suffix of the file storing the HTTP cache validators of a cached download
+CACHE_VALIDATORS_SUFFIX = '.validators'
+CACHE_VALIDATOR_HEADERS = {
+    # response header: conditional request header
+    'ETag': 'If-None-Match',
+    'Last-Modified': 'If-Modified-Since',
+}
+VERSION_1651 = parse_version('1.651')
 PLUGIN_PROD_LISTS = ('default.txt', 'optional.txt')
 PLUGIN_BLACKLIST = 'blacklist.txt'
 PLUGIN_TEST_LISTS = ('default-test.txt', 'optional-test.txt')
+# qualified tag names of the elements of interest in rpm repo primary XML
+RPM_PACKAGE_TAG = '{http://linux.duke.edu/metadata/common}package'
+RPM_NAME_TAG = '{http://linux.duke.edu/metadata/common}name'
+RPM_VERSION_TAG = '{http://linux.duke.edu/metadata/common}version'
+RPM_TIME_TAG = '{http://linux.duke.edu/metadata/common}time'
 
 
 def versioned_uc_url(uc_base_url, uc_version=None):
@@ -37,7 +53,11 @@ def versioned_uc_url(uc_base_url, uc_version=None):
     return '/'.join(join_args)
 
 
+@lru_cache(maxsize=None)
 def setup_cache_dir(uc_url):
+    # The cache dir for a given URL doesn't change, so only work it out (and create it) once
+    import appdirs
+
     user_cache_dir = appdirs.user_cache_dir('jm_parser')
     # rather than dealing with encoding the UC URL, or otherwise parsing it,
     # just hash it and use the hash to make the dir to stash the cache.
@@ -47,6 +67,38 @@ def setup_cache_dir(uc_url):
     return uc_cache_dir
 
 
+def read_cache_validators(cache_file):
+    # Return the request headers needed to conditionally request the cached download again, so
+    # that upstream can respond with "304 Not Modified" instead of the whole thing if the cached
+    # copy is still current. No headers are returned if no validators were stored.
+    try:
+        with open(cache_file + CACHE_VALIDATORS_SUFFIX, 'r') as f:
+            validators = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {CACHE_VALIDATOR_HEADERS[header]: value for header, value in validators.items()
+            if header in CACHE_VALIDATOR_HEADERS}
+
+
+def write_cache_validators(cache_file, response_headers):
+    # Stash the cache validators from the response that a cached download came from. They're
+    # written out to a temp file first, so that they're replaced all at once.
+    validators = {header: response_headers.get(header) for header in CACHE_VALIDATOR_HEADERS
+                  if response_headers.get(header)}
+    validators_file = cache_file + CACHE_VALIDATORS_SUFFIX
+    if not validators:
+        # Upstream didn't send any validators, so there's nothing to store. Validators stored for
+        # a previous download no longer describe the cached copy, so get rid of them.
+        try:
+            os.remove(validators_file)
+        except FileNotFoundError:
+            pass
+        return
+    with open(validators_file + '.tmp', 'w') as f:
+        json.dump(validators, f)
+    os.replace(validators_file + '.tmp', validators_file)
+
+
 def get_uc_data(uc_url, allow_prompt=False, ignore_cache=False):
     # retrieve, parse, and save remote UC JSON
     # it is retrieved into memory first to ensure it is parseable, and then re-saved locally
@@ -57,6 +109,8 @@ def get_uc_data(uc_url, allow_prompt=False, ignore_cache=False):
     # sentinel value, by default the cache is not updated unless certain conditions are met in the
     # following conditional chain
     download_uc = False
+    # headers making the download conditional, only used when the cache is valid but outdated
+    conditional_headers = {}
 
     # now do a bunch of stuff to decide if we need to download a new UC file
     # or if we can just use the cache.
@@ -74,8 +128,13 @@ def get_uc_data(uc_url, allow_prompt=False, ignore_cache=False):
             # user has explicitly request that the cache be ignored
             download_uc = True
         elif uc_cache_stat.st_mtime < (time.time() - 86400):
-            # cache is older than one day, prompt user to update if allowed
-            if allow_prompt:
+            # cache is older than one day, check upstream for changes if the cache validators are
+            # known, since that only downloads the UC again if it changed. Otherwise, prompt user
+            # to update if allowed
+            conditional_headers = read_cache_validators(uc_cache_file)
+            if conditional_headers:
+                download_uc = True
+            elif allow_prompt:
                 download_uc = click.confirm('Update Center cache is outdated, download again?',
                                             default=True)
             else:
@@ -89,18 +148,36 @@ def get_uc_data(uc_url, allow_prompt=False, ignore_cache=False):
         if allow_prompt:
             # don't leak prints in library code unless prompting is allowed
             print('Updating UC JSON cache from {}...'.format(uc_url))
-        response = urlopen(uc_url)
+        try:
+            with urlopen(Request(uc_url, headers=conditional_headers)) as response:
+                body = response.read()
+                response_headers = response.headers
+        except HTTPError as exc:
+            if exc.code != 304:
+                raise
+            # Not Modified, the cache is still current. The error holds the (empty) response, so
+            # close it rather than leaving its connection open until it's garbage collected.
+            exc.close()
+            # Touch the cache so that it isn't checked again for another day, and load it below.
+            os.utime(uc_cache_file, None)
+            download_uc = False
+
+    if download_uc:
         # The UC JSON isn't valid JSON. The actual JSON contents are wrapped in a
         # JavaScript function call, so a little parsing is required to find the
-        # opening and closing braces of the JSON inside for loading.
-        body = response.read().decode('utf8')
-        uc_data = json.loads(body[body.find('{'):body.rfind('}') + 1])
-        # stash the cache
-        json.dump(uc_data, open(uc_cache_file, 'w'))
+        # opening and closing braces of the JSON inside for loading. The braces are found in
+        # the raw response body, since JSON can be loaded from bytes without decoding it first.
+        uc_json = body[body.find(b'{'):body.rfind(b'}') + 1]
+        uc_data = json_loads(uc_json)
+        # stash the cache, the unwrapped JSON is already valid so it's written out as-is
+        with open(uc_cache_file, 'wb') as f:
+            f.write(uc_json)
+        write_cache_validators(uc_cache_file, response_headers)
     else:
         if allow_prompt:
             print('Loading UC JSON from cache of {}...'.format(uc_url))
-        uc_data = json.load(open(uc_cache_file, 'r'))
+        with open(uc_cache_file, 'rb') as f:
+            uc_data = json_loads(f.read())
 
     # ...and finally
     return uc_data
@@ -109,7 +186,8 @@ def get_uc_data(uc_url, allow_prompt=False, ignore_cache=False):
 def get_available_plugins(uc_data):
     available_plugins = {}
     # reduce each plugin in this list to its JenkinsPlugin repr, along with
-    # the JenkinsPlugin repr of each of its dependencies
+    # the JenkinsPlugin repr of each of its dependencies, indexed by plugin name
+    # so that lookups don't need to scan every available plugin
     for plugin_name, plugin_data in uc_data['plugins'].items():
         jp = JenkinsPlugin(plugin_name, plugin_data['version'])
         dependencies = []
@@ -119,22 +197,18 @@ def get_available_plugins(uc_data):
                 # absolutely minimum required deps for a given plugin
                 continue
             dependencies.append(JenkinsPlugin(dep['name'], dep['version']))
-        available_plugins[jp] = dependencies
+        available_plugins[plugin_name] = (jp, dependencies)
     return available_plugins
 
 
-def get_latest_version(plugin_name, plugin_iterable):
+def get_latest_version(plugin_name, available_plugins):
     """Get the latest available version for named plugin"""
-    if JenkinsPlugin(plugin_name, '0') not in plugin_iterable:
-        # short out using equality/hash identity if plugin is not in iterable
+    # an update center only lists one version of each plugin, which is the latest
+    try:
+        return available_plugins[plugin_name][0]
+    except KeyError:
         raise PluginNotFound(plugin_name)
 
-    latest_plugin = None
-    for plugin in filter(lambda plugin: plugin.name == plugin_name, plugin_iterable):
-        if latest_plugin is None or plugin > latest_plugin:
-            latest_plugin = plugin
-    return latest_plugin
-
 
 def supported_date_generator():
     # The start date of the 6-month rolling jenkins support cycle is Sept 1, 2017, with Jenkins
@@ -142,6 +216,8 @@ def supported_date_generator():
     # simplicity this generator starts out 6 months before the Sept 1 start date, which will be
     # manually paired up with 1.651. Supported versions will be calculated based on the Sept 1
     # thereafter.
+    import arrow
+
     date = arrow.Arrow(2017, 3, 1)
     while True:
         # Ensure we don't report supporting release dates in the future
@@ -155,95 +231,168 @@ def supported_date_generator():
         date = date.shift(months=6)
 
 
-def depsolve(plugin_name, available_plugins, dependencies=None):
-    """Given a plugin, recursively solve its dependencies.
+def depsolve(plugin_name, available_plugins):
+    """Given a plugin, solve its dependencies.
+
+    The dependency tree is walked breadth-first, and each plugin in it is only looked up once,
+    regardless of how many other plugins depend on it.
 
     Args:
         plugin_name: name of the plugin in the update center being parsed
-        available_plugins: dict of JenkinsPlugin: [list of JenkinsPlugin dependencies]
-        dependencies: optional list of dependencies recursively updated in-place
-    """
-    if dependencies is None:
-        # If no dependencies are passed in, initialize the list with the first dependency,
-        # which is the plugin being depsolved itself.
-        dependencies = [get_latest_version(plugin_name, available_plugins)]
-
-    # find the dependencies for the plugin we're trying to solve
-    for plugin, plugin_dependencies in available_plugins.items():
-        if plugin.name == plugin_name:
-            break
-    else:
-        raise PluginNotFound(plugin_name)
+        available_plugins: dict of plugin name: (JenkinsPlugin, [list of JenkinsPlugin deps])
 
-    for plugin in plugin_dependencies:
-        for i, dep in enumerate(dependencies):
-            if plugin == dep:
-                if plugin > dep:
-                    # If this requirement is newer than an existing one, update it in-place.
-                    dependencies[i] = plugin
-                break
-        else:
-            # If this plugin has not yet been seen in the dependencies list, add it
-            dependencies.append(plugin)
+    Returns a list of JenkinsPlugin, starting with the latest version of the plugin being solved,
+    followed by its dependencies at the highest version required of each one.
+    """
+    # Initialize the dependencies with the first dependency, which is the plugin being depsolved
+    # itself. Dependencies are tracked by name to make finding already-seen plugins easy.
+    dependencies = {plugin_name: get_latest_version(plugin_name, available_plugins)}
+    solved = set()
+    unsolved = deque([plugin_name])
+    while unsolved:
+        name = unsolved.popleft()
+        if name in solved:
+            continue
+        solved.add(name)
 
-        # recursively resolve the dependencies for this plugin
-        depsolve(plugin.name, available_plugins, dependencies)
+        # find the dependencies for the plugin we're trying to solve
+        try:
+            plugin_dependencies = available_plugins[name][1]
+        except KeyError:
+            raise PluginNotFound(name)
+
+        for plugin in plugin_dependencies:
+            dep = dependencies.get(plugin.name)
+            if dep is None or plugin > dep:
+                # If this plugin has not yet been seen in the dependencies, add it, or if this
+                # requirement is newer than an existing one, update it.
+                dependencies[plugin.name] = plugin
+            if plugin.name not in solved:
+                unsolved.append(plugin.name)
+
+    dependencies = list(dependencies.values())
     for plugin in dependencies:
         # Warn if the resolved dependies result in a newer plugin than this UC can provide
         warn_if_newer_plugin(plugin, available_plugins)
     return dependencies
 
 
+def _iter_rpm_packages(primary_xml):
+    # Given a file-like object of rpm repo primary XML, generate a tuple of
+    # (name, version, build timestamp) strings for each rpm package in it. The XML is parsed
+    # incrementally, and each package element is cleared out once it's been looked at, so the
+    # entire package list is never held in memory.
+    from xml.etree.ElementTree import iterparse
+
+    for event, element in iterparse(primary_xml):
+        if element.tag != RPM_PACKAGE_TAG:
+            continue
+        if element.get('type') == 'rpm':
+            name = version_str = build_date_str = None
+            for child in element:
+                if child.tag == RPM_NAME_TAG:
+                    name = child.text
+                elif child.tag == RPM_VERSION_TAG:
+                    version_str = child.get('ver')
+                elif child.tag == RPM_TIME_TAG:
+                    build_date_str = child.get('build')
+            yield name, version_str, build_date_str
+        element.clear()
+
+
+def get_jenkins_rpm_versions(repo_base):
+    # Return a list of (version, build timestamp) string tuples for each jenkins rpm in the repo at
+    # repo_base. The list is cached, and the (small) repo metadata is requested conditionally to
+    # check whether the cache is still current, so the (large) package list is only downloaded and
+    # parsed again when the repo changes.
+
+    # only this function needs these, so importing them is deferred until here to keep the
+    # import time of other commands down
+    import gzip
+    from xml.etree.ElementTree import fromstring
+
+    import requests
+
+    versions_cache_file = os.path.join(setup_cache_dir(repo_base), JENKINS_RPM_VERSIONS_JSON)
+    if os.path.exists(versions_cache_file):
+        conditional_headers = read_cache_validators(versions_cache_file)
+    else:
+        conditional_headers = {}
+
+    # Both downloads come from the same host, so they share a session to reuse the connection
+    with requests.Session() as session:
+        # so, first get the repo metadata to find the "primary" XML (package list)
+        with session.get(repo_base + 'repodata/repomd.xml',
+                         headers=conditional_headers) as repomd_response:
+            if repomd_response.status_code == 304:
+                # Not Modified, so the package list hasn't changed either
+                with open(versions_cache_file, 'r') as f:
+                    return [tuple(version) for version in json.load(f)]
+            repomd_response.raise_for_status()
+            repomd = fromstring(repomd_response.content)
+            repomd_headers = repomd_response.headers
+        # etree's namespaces make this a little sad to look at :(
+        primary_location = repomd.find(
+            './{http://linux.duke.edu/metadata/repo}data[@type="primary"]'
+            '/{http://linux.duke.edu/metadata/repo}location'
+        )
+
+        # Now, use the primary xml href to grab the package list. The raw response is read
+        # to make sure that the gzipped XML is never transparently decompressed by requests.
+        # It's decompressed and parsed as it streams in, so neither the compressed nor the
+        # decompressed XML is ever held in memory all at once.
+        # We only care about 'jenkins' rpms, which I'm pretty sure is all that's in this repo.
+        # Ideally, we'd be able to express exactly this with an XPath selector and not have to
+        # filter these in Python, but elementtree's xpath parser is extremely limited and can't do
+        # this.
+        with session.get(repo_base + primary_location.attrib['href'],
+                         stream=True) as primary_response:
+            primary_response.raise_for_status()
+            with gzip.GzipFile(fileobj=primary_response.raw) as primary_xml:
+                jenkins_rpm_versions = [
+                    (version_str, build_date_str)
+                    for name, version_str, build_date_str in _iter_rpm_packages(primary_xml)
+                    if name == 'jenkins'
+                ]
+
+    # stash the cache, writing it out to a temp file first so that a valid cache file is never
+    # replaced with a partially written one
+    versions_cache_tmp = versions_cache_file + '.tmp'
+    with open(versions_cache_tmp, 'w') as f:
+        json.dump(jenkins_rpm_versions, f)
+    os.replace(versions_cache_tmp, versions_cache_file)
+    write_cache_validators(versions_cache_file, repomd_headers)
+    return jenkins_rpm_versions
+
+
 def supported_versions():
     # So...we need a way to get at the currently available versions of the Jenkins LTS releases, as
     # well as machine-parseable dates related to them. This approach is to parse the repo metadata
     # from the "rpm-stable" repo to get at the data, which is...circuitous?
-    repo_base = 'https://pkg.jenkins.io/redhat-stable/'
-
-    # so, first get the repo metadata to find the "primary" XML (package list)
-    repomd_response = urlopen(repo_base + 'repodata/repomd.xml')
-    repomd = fromstring(repomd_response.read().decode('utf8'))
-    # etree's namespaces make this a little sad to look at :(
-    primary_location = repomd.find(
-        './{http://linux.duke.edu/metadata/repo}data[@type="primary"]'
-        '/{http://linux.duke.edu/metadata/repo}location'
-    )
+    import arrow
 
-    # Now, use the primary xml href to grab the package list
-    primary_response = urlopen(repo_base + primary_location.attrib['href'])
-    primary_gzip = gzip.decompress(primary_response.read())
-    primary_xml = fromstring(primary_gzip.decode('utf8'))
-    # We only care about 'jenkins' rpms, which I'm pretty sure is all that's in this repo.
-    # Ideally, we'd be able to express exactly this with an XPath selector and not have to filter
-    # these in Python, but elementtree's xpath parser is extremely limited and can't do this.
-    packages = primary_xml.findall('./{http://linux.duke.edu/metadata/common}package[@type="rpm"]')
     interesting_versions = defaultdict(list)
-    for package in packages:
-        if package.find('./{http://linux.duke.edu/metadata/common}name').text != 'jenkins':
-            # not jenkins, skip it
-            continue
-
-        version_str = package.find('./{http://linux.duke.edu/metadata/common}version').get('ver')
-        version = LooseVersion(version_str)
-        if version < VERSION_1651:
+    for version_str, build_date_str in get_jenkins_rpm_versions(JENKINS_RPM_REPO):
+        if parse_version(version_str) < VERSION_1651:
             # older than 1.651, don't care
             continue
 
-        build_date_str = package.find('./{http://linux.duke.edu/metadata/common}time').get('build')
         build_date = arrow.get(build_date_str)
         xy_version = '.'.join(version_str.split('.')[:2])
-        interesting_versions[xy_version].append((version, build_date))
+        interesting_versions[xy_version].append((version_str, build_date))
 
     # the ordering in the XML appears to be oldest to newest, but for reliable processing later,
     # the list of interesting versions for a given xy version should be sorted to ensure the x.y.1
     # version is always the first element of the interesting versions list
     for xy_version in interesting_versions:
         interesting_versions[xy_version] = sorted(interesting_versions[xy_version],
-                                                  key=lambda v: v[0])
+                                                  key=lambda v: parse_version(v[0]))
 
     # now that the values are sorted, get to work on the sorted interesting versions themselves
     supported_versions = []
     date_generator = supported_date_generator()
+    # the x.y versions are walked in order once per supported date, so only sort them once
+    sorted_xy_versions = sorted(interesting_versions, key=parse_version)
 
     # seed supported versions with 1.651.3 at the earliest supported date
     # supported versions is a tuple of:
@@ -260,7 +409,7 @@ def supported_versions():
     # release since our support policy
     for supported_date in date_generator:
         most_recent_offset = 0
-        for xy_version in sorted(interesting_versions, key=lambda v: LooseVersion(v)):
+        for xy_version in sorted_xy_versions:
             first_build = interesting_versions[xy_version][0][1]
             build_stamp_offset = (supported_date - first_build).total_seconds()
             if build_stamp_offset < 0:
@@ -298,14 +447,14 @@ def diff_uc_plugins(uc_urls_a, uc_urls_b, ignore_cache=False):
         plugins_b.update(get_available_plugins(uc_data))
 
     # get diffy, report plugins in set 'a' not in set 'b' and vice versa
-    diff_a = filter(lambda p: p not in plugins_b, plugins_a)
-    diff_b = filter(lambda p: p not in plugins_a, plugins_b)
+    diff_a = [plugins_a[name][0] for name in plugins_a if name not in plugins_b]
+    diff_b = [plugins_b[name][0] for name in plugins_b if name not in plugins_a]
 
     return diff_a, diff_b
 
 
-def warn_if_newer_plugin(plugin, plugin_iterable):
-    """Warn if a given plugin version in unavailable in a given iterable.
+def warn_if_newer_plugin(plugin, available_plugins):
+    """Warn if a given plugin version in unavailable in a given available plugins dict.
 
     Useful to see if a solved list of dependencies includes plugins that are not available for
     a given jenkins distribution version.
@@ -313,16 +462,19 @@ def warn_if_newer_plugin(plugin, plugin_iterable):
     This shouldn't happen if the UC being parsed is entirely self-consistent, but there are cases
     they upstream UCs have inconsistent dependencies and caution is warranted.
     """
-    avail_plugin = find_plugin(plugin.name, plugin_iterable)
-    if avail_plugin is not None:
-        if plugin > avail_plugin:
-            warnings.warn(
-                '{} {} in is newer than available version {}'.format(
-                    plugin.name, plugin.version, avail_plugin.version),
-                RuntimeWarning, stacklevel=2)
-
-
-def _refine_plugin_list(plugin_list, seen_plugins=[]):
+    try:
+        avail_plugin = available_plugins[plugin.name][0]
+    except KeyError:
+        # not available at all, which callers handle themselves if they care
+        return
+    if plugin > avail_plugin:
+        warnings.warn(
+            '{} {} in is newer than available version {}'.format(
+                plugin.name, plugin.version, avail_plugin.version),
+            RuntimeWarning, stacklevel=2)
+
+
+def _refine_plugin_list(plugin_list, seen_plugins=None):
     # not in love with this function name, but the idea's pretty simple:
     # given a list of plugins, return a similar list with duplicated removed,
     # including only the highest versions of each plugin seen. This is useful
@@ -330,17 +482,17 @@ def _refine_plugin_list(plugin_list, seen_plugins=[]):
     # many plugins in a given list may request the same plugin name at different
     # versions; this refines a list made with that in mind down to the highest
     # requested version of a given plugin. Also supports filtering out already-seen
-    # plugins
+    # plugins, given as a set of plugin names
+    if seen_plugins is None:
+        seen_plugins = set()
     refined_plugins = {}
     for plugin in plugin_list:
         if plugin.name in seen_plugins:
             continue
-        try:
-            # overwrite the value in the refined plugin list if it's there at a lower version...
-            if refined_plugins[plugin.name] < plugin:
-                refined_plugins[plugin.name] = plugin
-        except KeyError:
-            # ...or just do the initial assignment if it's not there at all
+        refined_plugin = refined_plugins.get(plugin.name)
+        # do the initial assignment if it's not in the refined plugin list at all, or overwrite
+        # the value in the refined plugin list if it's there at a lower version
+        if refined_plugin is None or refined_plugin < plugin:
             refined_plugins[plugin.name] = plugin
     return list(refined_plugins.values())
 
@@ -352,23 +504,22 @@ def _process_plugin_list(plugin_list_file, available_plugins, remove_missing=Fal
     removed_plugins = set()
 
     with open(plugin_list_file, 'r') as infile:
-        lines_in = infile.readlines()
+        lines_in = infile.read().splitlines()
     plugins_out = []
     for line in lines_in:
-        try:
-            plugin = JenkinsPlugin(*line.strip().split('=='))
-        except (TypeError, ValueError):
+        name, sep, version = line.strip().partition('==')
+        if not sep:
             # no '==' in line to split on, entire line is plugin name
             # instantiate with version of 0 to ensure plugin gets updated at some point with a
             # "real" version in later processing
-            plugin = JenkinsPlugin(line.strip(), '0')
+            version = '0'
+        plugin = JenkinsPlugin(name, version)
 
         if not plugin.name:
             # plugin name is blank, maybe a blank line in a plugin list
             continue
         # check if plugin is not available upstream (removed or added in later version)
-        avail_plugin = find_plugin(plugin.name, available_plugins)
-        if avail_plugin is not None:
+        if plugin.name in available_plugins:
             warn_if_newer_plugin(plugin, available_plugins)
         else:
             removed_plugins.add(plugin.name)
@@ -381,9 +532,12 @@ def _process_plugin_list(plugin_list_file, available_plugins, remove_missing=Fal
 
 
 def _write_plugin_list(plugin_list_file, plugin_list):
+    # Entries are sorted as whole lines (rather than by plugin name) to keep the ordering of
+    # existing plugin lists stable, e.g. 'git-client==...' sorts before 'git==...'. The file
+    # contents are built up front and written out in one go.
+    lines_out = sorted(plugin.plugin_list_entry for plugin in plugin_list)
     with open(plugin_list_file, 'w') as outfile:
-        lines_out = sorted([plugin.plugin_list_entry for plugin in plugin_list])
-        outfile.writelines(lines_out)
+        outfile.write(''.join(lines_out))
 
 
 def update_plugin_lists(plugin_lists_dir, available_plugins, dry_run, test,
@@ -401,7 +555,10 @@ def update_plugin_lists(plugin_lists_dir, available_plugins, dry_run, test,
     # that plugin has been seen in a previous list. This is also what seen_plugins is tracking
     seen_plugins = set()
     missing_plugins = dict()
-    blacklist = _process_plugin_list(blacklist_file, [])[0]
+    # depsolve results only depend on the available plugins, so they're cached by plugin name
+    # and reused when a plugin is listed more than once, possibly in different lists
+    solved_plugins = dict()
+    blacklist = _process_plugin_list(blacklist_file, {})[0]
     for plugin_list_file in lists:
         plugin_list, removed_plugins = _process_plugin_list(
             plugin_list_file, available_plugins, remove_missing)
@@ -425,10 +582,12 @@ def update_plugin_lists(plugin_lists_dir, available_plugins, dry_run, test,
             for plugin in plugin_list:
                 # since depsolve includes the latest version of a given plugin as its first result,
                 # this also ends up updating every plugin in the list, which is what we want
-                try:
-                    extended_deps.extend(depsolve(plugin.name, available_plugins))
-                except PluginNotFound:
-                    pass
+                if plugin.name not in solved_plugins:
+                    try:
+                        solved_plugins[plugin.name] = depsolve(plugin.name, available_plugins)
+                    except PluginNotFound:
+                        solved_plugins[plugin.name] = []
+                extended_deps.extend(solved_plugins[plugin.name])
             plugin_list.extend(extended_deps)
 
         # now refine the plugin list to get us the list of all the latest plugins and their
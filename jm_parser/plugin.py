@@ -1,6 +1,26 @@
-import hashlib
+import re
 from collections import namedtuple
-from distutils.version import LooseVersion
+from functools import lru_cache
+
+# Splits version strings the same way as distutils' (deprecated) LooseVersion
+VERSION_COMPONENT_RE = re.compile(r'(\d+|[a-z]+|\.)')
+
+
+@lru_cache(maxsize=None)
+def parse_version(version):
+    # Parse a version string into a tuple that compares the same way distutils' LooseVersion
+    # does: numeric components become ints, and everything else is left as a string.
+    # Version strings get compared over and over again while sorting and depsolving, so parse
+    # each distinct version string only once.
+    components = []
+    for component in VERSION_COMPONENT_RE.split(version):
+        if not component or component == '.':
+            continue
+        try:
+            components.append(int(component))
+        except ValueError:
+            components.append(component)
+    return tuple(components)
 
 
 class JenkinsPlugin(namedtuple('_JP', ('name', 'version'))):
@@ -24,22 +44,22 @@ class JenkinsPlugin(namedtuple('_JP', ('name', 'version'))):
         # implement __hash__ to make this tuple usable as a dict key
         # Similar to equality, this objects hash identity is based on its name,
         # and excludes the version piece, allowing "key in dict" lookups to
-        # succeed when key is a plugin with a different version.
-        hash_bytes = self.name.encode()
-        return int(hashlib.md5(hash_bytes).hexdigest(), 16)
+        # succeed when key is a plugin with a different version. The name is
+        # lowercased to stay consistent with __eq__.
+        return hash(self.name.lower())
 
-    # Rich comparison functions delegate version comparison to LooseVersion
+    # Rich comparison functions delegate version comparison to parse_version
     def __lt__(self, other):
-        return LooseVersion(self.version) < LooseVersion(other.version)
+        return parse_version(self.version) < parse_version(other.version)
 
     def __le__(self, other):
-        return LooseVersion(self.version) <= LooseVersion(other.version)
+        return parse_version(self.version) <= parse_version(other.version)
 
     def __gt__(self, other):
-        return LooseVersion(self.version) > LooseVersion(other.version)
+        return parse_version(self.version) > parse_version(other.version)
 
     def __ge__(self, other):
-        return LooseVersion(self.version) >= LooseVersion(other.version)
+        return parse_version(self.version) >= parse_version(other.version)
 
     @property
     def plugin_list_entry(self):
@@ -1,102 +1,261 @@
+import hashlib
 import os
-from contextlib import ExitStack
+import posixpath
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
+import lxml.html
 import requests
-import scrapy
-from scrapy.crawler import Crawler, CrawlerRunner
-from scrapy.settings import Settings
-from twisted.internet import reactor
-from twisted.internet.error import ReactorNotRestartable
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-SCRAPY_SETTINGS = Settings({
-    'LOG_LEVEL': 'WARNING'
-})
+from .exceptions import DownloadsFailed
+from .parsing import read_cache_validators, setup_cache_dir, write_cache_validators
 
+# index pages listing all the stable jenkins rpms and wars, and templates for their download URLs
+RPM_INDEX_URL = 'https://pkg.jenkins.io/redhat-stable/'
+RPM_HREF_TEMPLATE = 'https://pkg.jenkins.io/redhat-stable/{}'
+WAR_INDEX_URL = 'http://mirrors.jenkins.io/war-stable/'
+WAR_HREF_TEMPLATE = 'http://mirrors.jenkins.io/war-stable/{}/jenkins.war'
+# anchors with an href starting with $prefix, compiled once and reused for every index page.
+# Nothing needs string results linked back to their elements, so smart_strings is turned off.
+ANCHOR_HREF_XPATH = etree.XPath('//a[starts-with(@href, $prefix)]', smart_strings=False)
+# (connect, read) timeouts for downloads, in seconds
+DOWNLOAD_TIMEOUT = (5, 60)
+# rpms and wars are tens of MB, so download (and write) them in large chunks
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# files up to this size are downloaded in one read, rather than in chunks
+DOWNLOAD_BULK_SIZE = 64 * 1024
+# Index pages are HTML that compresses well, so make sure they're sent compressed. The rpms and
+# wars are already compressed archives, so ask for them as-is, which also keeps their
+# content-length the actual file size for preallocating, progress bars, and completeness checks.
+INDEX_HEADERS = {'Accept-Encoding': 'gzip, deflate'}
+DOWNLOAD_HEADERS = {'Accept-Encoding': 'identity'}
+# key of the cache dir holding the cache validators of downloaded files
+DOWNLOADS_CACHE_KEY = 'downloads'
+# minimum number of files downloaded at the same time when scraping
+DOWNLOAD_WORKERS = 8
 
-def download_file(url, local_filename, allow_prompt=False):
+
+def download_session(pool_size=DOWNLOAD_WORKERS):
+    # requests session for downloading files, which keeps connections alive to reuse them for
+    # multiple downloads from the same host, and retries failed connections and gateway errors.
+    # pool_size should be at least the number of threads using the session, otherwise threads
+    # end up waiting on each other for a connection to the same host.
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _validators_cache_file(url, local_filename):
+    # Cache validators for downloads are kept in the user cache dir rather than next to the
+    # downloaded files, so that nothing but the downloads ends up in the dist dir. They're all kept
+    # in the same dir, and since they only describe the local copy of the file they were
+    # downloaded with, they're stored per URL and local file.
+    h = hashlib.md5('{}\n{}'.format(url, os.path.abspath(local_filename)).encode('utf8'))
+    return os.path.join(setup_cache_dir(DOWNLOADS_CACHE_KEY), h.hexdigest())
+
+
+def _download_is_complete(url, local_filename, session=None):
+    # Without any cache validators for an existing file, the best that can be done is to compare
+    # its size to the upstream file size, which at least catches files left truncated by an
+    # interrupted download. If upstream doesn't report a size, the file is assumed to be complete.
+    head = requests.head if session is None else session.head
+    with head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT, headers=DOWNLOAD_HEADERS) as r:
+        content_length = r.headers.get('content-length')
+        if not r.ok or not content_length:
+            return True
+    return int(content_length) == os.path.getsize(local_filename)
+
+
+def download_file(url, local_filename, allow_prompt=False, session=None, progress_bar=True):
+    # headers making the download conditional, if the file has been downloaded before
+    conditional_headers = {}
     if os.path.exists(local_filename):
-        # don't redownload if file exists
-        if allow_prompt:
-            click.echo('{} exists, skipping download.'.format(local_filename))
-        return
-    # stream for chunked download processing
-    r = requests.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        # instantiate a bar context manager:
-        # - if we're allowed to prompt the user, and know how large the file we're downloading is,
-        #   display a "real" progress bar
-        # - otherwise, use ExitStack, which is a noop context manager
-        if allow_prompt and r.headers.get('content-length'):
-            bar = click.progressbar(length=int(r.headers['content-length']),
-                                    label='Downloading {}'.format(local_filename))
-        else:
-            bar = ExitStack()
-
-        with bar as bar_ctx:
-            # chunk size results in decent download speeds without hitting memory too hard, while
-            # also giving us decently frequent progress updates in the likely event we ended up
-            # displaying a progress bar
-            for chunk in r.iter_content(chunk_size=4096):
-                f.write(chunk)
-                if not isinstance(bar_ctx, ExitStack):
-                    bar_ctx.update(len(chunk))
-
-
-class JenkinsRPMScraper(scrapy.Spider):
-    name = 'jenkins_rpm_scraper'
-    start_urls = [
-        'https://pkg.jenkins.io/redhat-stable/'
-    ]
-    href_template = 'https://pkg.jenkins.io/redhat-stable/{}'
-
-    def parse(self, response):
-        match_str = './jenkins-{}.'.format(self.xy_version)
-        anchors = response.selector.xpath('//a[starts-with(@href, "{}")]'.format(match_str))
-        for a in anchors:
-            # anchor text is in the format 'jenkins-x.y.z-relx.rely.rpm', which is what we want
-            href = self.href_template.format(a.root.text)
-            filename = os.path.join(self.dist_dir, 'rpm', a.root.text)
-            download_file(href, filename, self.allow_prompt)
-
-
-class JenkinsWarScraper(scrapy.Spider):
-    name = 'jenkins_war_scraper'
-    start_urls = [
-        'http://mirrors.jenkins.io/war-stable/'
-    ]
-    href_template = 'http://mirrors.jenkins.io/war-stable/{}/jenkins.war'
-
-    def parse(self, response):
-        match_str = '{}.'.format(self.xy_version)
-        anchors = response.selector.xpath('//a[starts-with(@href, "{}")]'.format(match_str))
-        for a in anchors:
-            # anchor text is in the format "x.y.z/", so strip slashes to generate the URL,
-            # and generate a new filename based on the xyz version
-            xyz_version = a.root.text.strip('/')
-            href = self.href_template.format(xyz_version)
-            filename = os.path.join(self.dist_dir, 'war', 'jenkins-{}.war'.format(xyz_version))
-            download_file(href, filename, self.allow_prompt)
+        # if the cache validators from when the file was downloaded are known, ask upstream
+        # to only send the file again if it has changed, otherwise don't redownload if file exists
+        # and looks complete
+        conditional_headers = read_cache_validators(_validators_cache_file(url, local_filename))
+        if not conditional_headers:
+            if _download_is_complete(url, local_filename, session):
+                if allow_prompt:
+                    click.echo('{} exists, skipping download.'.format(local_filename))
+                return
+            if allow_prompt:
+                click.echo('{} is incomplete, downloading again.'.format(local_filename))
+    # stream for chunked download processing, using the given session's connections if possible
+    get = requests.get if session is None else session.get
+    headers = dict(DOWNLOAD_HEADERS)
+    headers.update(conditional_headers)
+    with get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as r:
+        if r.status_code == 304:
+            # Not Modified, the existing file is current
+            if allow_prompt:
+                click.echo('{} is up to date, skipping download.'.format(local_filename))
+            return
+        r.raise_for_status()
+
+        # Download to a temporary file, and only move it into place once it's complete, so an
+        # interrupted download doesn't leave a truncated file behind
+        # 0 if upstream didn't say how large the file is
+        content_length = int(r.headers.get('content-length') or 0)
+        tmp_filename = local_filename + '.tmp'
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            with open(fd, 'wb') as f:
+                if content_length > DOWNLOAD_BULK_SIZE and hasattr(os, 'posix_fallocate'):
+                    # allocate space for the whole file at once, rather than growing it with
+                    # every chunk
+                    try:
+                        os.posix_fallocate(fd, 0, content_length)
+                    except OSError:
+                        # not supported by every filesystem, in which case the file grows as usual
+                        pass
+
+                # small files aren't worth streaming, or displaying a progress bar for, so read
+                # them in one go
+                if 0 < content_length <= DOWNLOAD_BULK_SIZE:
+                    f.write(r.content)
+                # if we're allowed to prompt the user, want a progress bar (which isn't the case
+                # when downloading several files at once), and know how large the file we're
+                # downloading is, display a progress bar while downloading the file
+                elif allow_prompt and progress_bar and content_length:
+                    # chunk size results in decent download speeds without hitting memory too
+                    # hard, while also giving us decently frequent progress updates
+                    chunks = r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+                    with click.progressbar(length=content_length,
+                                           label='Downloading {}'.format(local_filename)) as bar:
+                        write, update = f.write, bar.update
+                        for chunk in chunks:
+                            write(chunk)
+                            update(len(chunk))
+                else:
+                    # otherwise there's nothing to do for each chunk, so copy the raw response
+                    # straight into the file, decoding it the same way iter_content would
+                    r.raw.decode_content = True
+                    shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
+                # content-length is the encoded size, so the decoded content may not fill all of
+                # the allocated space
+                f.truncate()
+            os.replace(tmp_filename, local_filename)
+        except BaseException:
+            # don't leave a partial download behind, which could be as large as the whole file
+            # since its space was allocated up front
+            os.unlink(tmp_filename)
+            raise
+        # the download is complete, so keep its cache validators for revalidating it later
+        write_cache_validators(_validators_cache_file(url, local_filename), r.headers)
+    if allow_prompt and not progress_bar:
+        click.echo('Downloaded {}'.format(local_filename))
+
+
+def fetch_index(session, index_url):
+    # The index pages are small, static listings of links, so fetch and parse them in one go
+    r = session.get(index_url, timeout=DOWNLOAD_TIMEOUT, headers=INDEX_HEADERS)
+    r.raise_for_status()
+    return lxml.html.fromstring(r.content)
+
+
+def _index_anchor_texts(index, match_str):
+    # text of every anchor in a parsed index page whose href starts with match_str
+    return [a.text for a in ANCHOR_HREF_XPATH(index, prefix=match_str)]
+
+
+def list_rpm_hrefs(rpm_index, xy_version):
+    # anchor text is in the format 'jenkins-x.y.z-relx.rely.rpm', which is what we want
+    anchor_texts = _index_anchor_texts(rpm_index, './jenkins-{}.'.format(xy_version))
+    return [RPM_HREF_TEMPLATE.format(text) for text in anchor_texts]
+
+
+def list_war_versions(war_index, xy_version):
+    # anchor text is in the format "x.y.z/", so strip slashes to get the xyz version
+    anchor_texts = _index_anchor_texts(war_index, '{}.'.format(xy_version))
+    return [text.strip('/') for text in anchor_texts]
+
+
+def _rpm_downloads(rpm_index, xy_versions, dist_dir):
+    # (href, local filename) of every rpm to download for xy_versions
+    for xy_version in xy_versions:
+        for href in list_rpm_hrefs(rpm_index, xy_version):
+            yield href, os.path.join(dist_dir, 'rpm', posixpath.basename(href))
+
+
+def _war_downloads(war_index, xy_versions, dist_dir):
+    # (href, local filename) of every war to download for xy_versions. Every war upstream is
+    # named jenkins.war, so generate a new filename based on the xyz version.
+    for xy_version in xy_versions:
+        for xyz_version in list_war_versions(war_index, xy_version):
+            yield (WAR_HREF_TEMPLATE.format(xyz_version),
+                   os.path.join(dist_dir, 'war', 'jenkins-{}.war'.format(xyz_version)))
 
 
 def scrape_for_versions(xy_versions, dist_dir, allow_prompt=False):
-    spider_kwargs = {
-        'dist_dir': dist_dir,
-        'allow_prompt': allow_prompt,
-    }
-
-    runner = CrawlerRunner()
-    for spider_class in (JenkinsRPMScraper, JenkinsWarScraper):
-        for xy_version in xy_versions:
-            crawler = Crawler(spider_class, SCRAPY_SETTINGS)
-            runner.crawl(crawler, xy_version=xy_version, **spider_kwargs)
-    deferred = runner.join()
-    # stop the reactor on success or error
-    deferred.addBoth(lambda _: reactor.stop())
+    # every x.y version has a few rpms and wars to download, so scale the number of workers with
+    # the number of versions
+    workers = max(DOWNLOAD_WORKERS, len(xy_versions) * 2)
+    # all the downloads come from the same couple of hosts, so they share a session, with enough
+    # connections in its pools for every worker
+    session = download_session(workers)
+    # The executor is shut down explicitly rather than with a with block, since leaving a with
+    # block always waits for every queued download, which makes ctrl-c look like a hang
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # index fetches, mapped to their index URL and the function listing their downloads
+    index_fetches = {}
+    # files are downloaded in the executor rather than one at a time, keep track of them by local
+    # filename in the downloads dict
+    downloads = {}
+
     try:
-        reactor.run()
-    except ReactorNotRestartable:
-        # This is an expection. We aren't trying to restart the reactor at this point,
-        # since it should have been stopped with the callback. Regardless, twisted still
-        # throws this exception and I didn't feel terribly interested in finding out why.
-        pass
+        # The same index pages list the files for every version, so only fetch them once.
+        # Fetch both at the same time, and start downloading files from whichever index
+        # arrives first, rather than waiting for the other.
+        for index_url, index_downloads in ((RPM_INDEX_URL, _rpm_downloads),
+                                           (WAR_INDEX_URL, _war_downloads)):
+            index_fetch = executor.submit(fetch_index, session, index_url)
+            index_fetches[index_fetch] = (index_url, index_downloads)
+        # One failure shouldn't stop everything else, so errors fetching an index or downloading a
+        # file are collected here, by index URL or local filename, and raised together at the end
+        errors = {}
+        for index_fetch in as_completed(index_fetches):
+            index_url, index_downloads = index_fetches[index_fetch]
+            try:
+                index = index_fetch.result()
+            except Exception as exc:
+                if allow_prompt:
+                    click.echo('Failed to download {}: {}'.format(index_url, exc), err=True)
+                errors[index_url] = exc
+                continue
+            for href, filename in index_downloads(index, xy_versions, dist_dir):
+                if filename in downloads:
+                    # the same version was asked for more than once, only download its files once,
+                    # otherwise two threads end up writing the same file at the same time
+                    continue
+                downloads[filename] = executor.submit(
+                    download_file, href, filename, allow_prompt, session, progress_bar=False)
+
+        # Wait for all the downloads to finish
+        for filename, download in downloads.items():
+            try:
+                download.result()
+            except Exception as exc:
+                if allow_prompt:
+                    click.echo('Failed to download {}: {}'.format(filename, exc), err=True)
+                errors[filename] = exc
+        if errors:
+            raise DownloadsFailed(errors)
+    except BaseException:
+        # Don't start any queued downloads when interrupted or failing, only wait for the ones
+        # that are already running. Cancelling a future that's running or done does nothing.
+        for future in list(index_fetches) + list(downloads.values()):
+            future.cancel()
+        executor.shutdown(wait=True)
+        raise
+    else:
+        executor.shutdown(wait=True)
+    finally:
+        session.close()